@@ -0,0 +1,130 @@
+"""
+Benchmark del árbol de retransmisión de Paint 3
+
+Levanta un host y N peers de Paint3 sin interfaz gráfica (root None) en
+localhost. Todo el tráfico pasa por el código real del juego
+(open_room, handle_peer, process_message, broadcast_data, receive_data,
+RelayTree y RelayNode). Compara cuántos envíos hace el host por mensaje,
+cuánto tarda cada broadcast en llegar a todos y cuántos se pierden.
+
+Uso:
+    python bench_relay.py --peers 50 --fanout 0    # estrella
+    python bench_relay.py --peers 50 --fanout 3    # árbol 3-ario
+    python bench_relay.py --peers 50 --fanout 3 --kill-relay
+"""
+
+import argparse
+import contextlib
+import io
+import time
+
+from lab3 import Paint3
+
+
+class BenchPeer(Paint3):
+    """Peer sin interfaz que anota cuándo llega cada broadcast"""
+
+    def __init__(self):
+        super().__init__(None)
+        self.received = {}  # {seq: instante de llegada}
+
+    def process_message(self, message, sender_socket):
+        if "seq" in message:
+            self.received[message["seq"]] = time.perf_counter()
+        super().process_message(message, sender_socket)
+
+
+def wait_for(condition, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def settled(host, n):
+    """Todos conectados y, con árbol, todos ubicados y confirmados"""
+    if len(host.connected_peers) < n or len(host.scores) <= n:
+        return False
+    tree = host.relay_tree
+    return not tree or (len(tree.parents) >= n and not tree.pending)
+
+
+def run(args):
+    host = Paint3(None)
+    host.my_name = "host"
+    host.open_room(0, args.fanout, bind_ip="127.0.0.1")
+
+    peers = []
+    for i in range(args.peers):
+        peer = BenchPeer()
+        peer.my_name = f"peer{i}"
+        peer.join_host("127.0.0.1", host.my_port)
+        peers.append(peer)
+
+    if not wait_for(lambda: settled(host, args.peers), 30):
+        print("Aviso: el árbol no se estabilizó a tiempo")
+
+    killed = None
+    sends_before = host.broadcast_sends
+    sent_at = {}
+    for i in range(args.messages):
+        if args.kill_relay and i == args.messages // 2 and host.relay_tree:
+            killed = next((p for p in peers if p.relay_node.children), None)
+            if killed:
+                peers.remove(killed)
+                killed.cleanup()
+        sent_at[host.broadcast_seq + 1] = time.perf_counter()
+        host.broadcast_data({"type": "draw", "x1": i, "y1": i, "x2": i + 1, "y2": i + 1})
+        time.sleep(args.interval)
+
+    wait_for(lambda: all(seq in p.received for p in peers for seq in sent_at), 5)
+
+    latencies = []
+    delivered = 0
+    for seq, start in sent_at.items():
+        arrivals = [p.received[seq] for p in peers if seq in p.received]
+        delivered += len(arrivals)
+        if arrivals:
+            latencies.append(max(arrivals) - start)
+
+    for peer in peers:
+        peer.cleanup()
+    host.cleanup()
+
+    return host.broadcast_sends - sends_before, sent_at, peers, delivered, latencies, killed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del árbol de relays")
+    parser.add_argument("--peers", type=int, default=50)
+    parser.add_argument("--fanout", type=int, default=3, help="0 = estrella")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.005,
+                        help="segundos entre broadcasts")
+    parser.add_argument("--kill-relay", action="store_true",
+                        help="desconecta un relay a mitad de la prueba")
+    args = parser.parse_args()
+
+    # El juego imprime mensajes DEBUG; se ocultan para ver solo el resultado
+    with contextlib.redirect_stdout(io.StringIO()):
+        sends, sent_at, peers, delivered, latencies, killed = run(args)
+
+    expected = len(sent_at) * len(peers)
+    print(f"peers={args.peers} fanout={args.fanout} mensajes={len(sent_at)}")
+    if killed:
+        print(f"relay desconectado: {killed.my_name}")
+    print(f"envíos del host por mensaje: {sends / len(sent_at):.1f}")
+    print(f"entregas: {delivered}/{expected} ({100 * delivered / expected:.1f}%), "
+          f"perdidos: {expected - delivered}")
+    if latencies:
+        latencies.sort()
+        print(f"latencia hasta el último peer: "
+              f"media={1000 * sum(latencies) / len(latencies):.2f}ms "
+              f"p95={1000 * latencies[int(0.95 * (len(latencies) - 1))]:.2f}ms "
+              f"max={1000 * latencies[-1]:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
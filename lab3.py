@@ -4,7 +4,9 @@ Laboratorio 3 - Estructura de Datos II
 Universidad del Norte
 
 Este módulo implementa el juego principal con arquitectura peer-to-peer,
-manejo de múltiples hilos y comunicación por sockets
+manejo de múltiples hilos y comunicación por sockets. Por defecto el host
+envía cada mensaje a todos los peers (estrella); opcionalmente puede
+organizar a los peers en un árbol de retransmisión (relays)
 """
 
 import tkinter as tk
@@ -14,8 +16,730 @@ import threading
 import json
 import time
 import random
+import secrets
+import queue
+import sqlite3
+from collections import deque
 from datetime import datetime
 
+
+def build_relay_tree(members, fanout):
+    """
+    Calcula un árbol k-ario con el host como raíz
+    members: lista ordenada de peers; devuelve {peer: padre} (None = host)
+    """
+    parents = {}
+    for i, member in enumerate(members):
+        # Con el host en la posición 0, el padre del nodo i+1 es (i // k)
+        parents[member] = members[i // fanout - 1] if i >= fanout else None
+    return parents
+
+
+class RelayTree:
+    """
+    Árbol de retransmisión del lado del host
+    Decide a qué peers envía el host directamente y quién reenvía a quién
+    """
+    
+    def __init__(self, fanout):
+        """Inicializa el árbol con k hijos por nodo"""
+        self.fanout = fanout
+        self.order = []  # Peers en posiciones del árbol
+        self.addresses = {}  # {socket: (ip, puerto_relay)}
+        self.parents = {}  # {socket: socket padre o None}
+        self.pending = set()  # Peers que aún no confirman a su nuevo padre
+        self.lock = threading.Lock()
+    
+    def add(self, peer, ip, relay_port):
+        """Agrega un peer capaz de retransmitir al final del árbol"""
+        with self.lock:
+            if peer not in self.addresses:
+                self.order.append(peer)
+            self.addresses[peer] = (ip, relay_port)
+    
+    def remove(self, peer):
+        """Quita un peer; el último ocupa su lugar para mover pocos nodos"""
+        with self.lock:
+            if peer not in self.addresses:
+                return
+            index = self.order.index(peer)
+            last = self.order.pop()
+            if last is not peer:
+                self.order[index] = last
+            del self.addresses[peer]
+            self.parents.pop(peer, None)
+            self.pending.discard(peer)
+    
+    def attached(self, peer, ip, relay_port):
+        """El peer confirmó que ya recibe del padre en (ip, relay_port)"""
+        with self.lock:
+            parent = self.parents.get(peer)
+            # Se ignoran confirmaciones de un padre que ya fue reemplazado
+            if parent is not None and self.addresses.get(parent) == (ip, relay_port):
+                self.pending.discard(peer)
+    
+    def rebuild(self):
+        """
+        Recalcula el árbol y devuelve solo los cambios
+        como lista de (peer, ip_padre, puerto_padre); ip None = host
+        """
+        with self.lock:
+            new_parents = build_relay_tree(self.order, self.fanout)
+            changes = []
+            for peer, parent in new_parents.items():
+                if peer in self.parents and self.parents[peer] is parent:
+                    continue
+                if parent is None:
+                    self.pending.discard(peer)
+                    changes.append((peer, None, None))
+                else:
+                    # Hasta que confirme, el host le sigue enviando directo
+                    self.pending.add(peer)
+                    changes.append((peer,) + self.addresses[parent])
+            self.parents = new_parents
+            return changes
+    
+    def detached(self, peer):
+        """
+        El peer perdió la conexión con su padre sin reasignación
+        Vuelve a recibir directo del host; devuelve la dirección del padre
+        """
+        with self.lock:
+            parent = self.parents.get(peer)
+            if parent is None:
+                return None
+            self.pending.add(peer)
+            return self.addresses[parent]
+    
+    def direct_targets(self, peers):
+        """Peers a los que el host debe enviar cada broadcast"""
+        with self.lock:
+            return [peer for peer in peers
+                    if self.parents.get(peer) is None or peer in self.pending]
+
+
+class RelayNode:
+    """
+    Lado cliente del árbol de retransmisión
+    Entrega los broadcasts en orden de seq y sin duplicados desde un único
+    hilo y, si el host usa árbol, acepta hijos, se conecta a su padre y
+    reenvía cada broadcast una sola vez.
+    
+    Modelo de confianza: un relay es un jugador más y podría alterar lo que
+    reenvía. Por eso por el árbol solo viajan los tipos de RELAYED_TYPES
+    (dibujo y chat); el resto (puntajes, rondas, lista de jugadores...) lo
+    envía el host directamente a cada peer, y lo que llegue de un padre con
+    otro tipo se descarta. Un relay malicioso solo puede ensuciar el dibujo
+    o el chat de su subárbol, no los puntajes ni el estado del juego
+    """
+    
+    RELAYED_TYPES = {"draw", "undo", "redo", "discard", "clear", "chat"}
+    
+    def __init__(self, on_message, on_parent_lost=None, window=1024, gap_timeout=2.0):
+        """
+        on_message se llama con cada broadcast nuevo, en orden de seq
+        on_parent_lost se llama si se cae la conexión con el padre
+        """
+        self.on_message = on_message
+        self.on_parent_lost = on_parent_lost
+        self.key = None  # Clave de la sala para aceptar hijos y conectarse al padre
+        self.listen_socket = None
+        self.parent_socket = None
+        self.attach_generation = 0  # Descarta conexiones de asignaciones viejas
+        self.children = []  # Sockets de los hijos conectados
+        self.inbox = queue.Queue()  # Broadcasts recibidos por cualquier conexión
+        self.held = {}  # {seq: (línea, mensaje)} que llegaron antes de tiempo
+        self.contiguous = None  # Mayor seq tal que no falta ninguno antes
+        self.window = window
+        self.gap_timeout = gap_timeout
+        self.gap_since = None  # Desde cuándo se espera un seq faltante
+        self.running = True
+        self.lock = threading.Lock()
+        threading.Thread(target=self.delivery_loop, daemon=True).start()
+    
+    def start(self, key, host="0.0.0.0"):
+        """
+        Abre el socket de escucha para hijos y devuelve su puerto
+        Solo se llama cuando el host avisa que usa árbol de relays
+        """
+        self.key = key
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.bind((host, 0))
+        self.listen_socket.listen(16)
+        threading.Thread(target=self.accept_children, daemon=True).start()
+        return self.listen_socket.getsockname()[1]
+    
+    def accept_children(self):
+        """Hilo que acepta conexiones de posibles hijos"""
+        while self.running:
+            try:
+                child, _ = self.listen_socket.accept()
+            except:
+                break
+            threading.Thread(target=self.serve_child, args=(child,), daemon=True).start()
+    
+    def serve_child(self, child):
+        """Valida la clave del hijo, lo agrega y detecta cuando se desconecta"""
+        try:
+            child.settimeout(5)
+            handshake = b""
+            while b"\n" not in handshake and len(handshake) < 256:
+                data = child.recv(256)
+                if not data:
+                    break
+                handshake += data
+            if handshake.split(b"\n", 1)[0].decode('utf-8', 'replace') != self.key:
+                child.close()
+                return
+            child.settimeout(None)
+            
+            with self.lock:
+                # Confirmación al hijo: desde aquí recibe todos los reenvíos
+                child.sendall(b"\n")
+                self.children.append(child)
+            
+            while self.running and child.recv(1024):
+                pass
+        except:
+            pass
+        self.drop_child(child)
+    
+    def drop_child(self, child):
+        """Saca a un hijo de la lista y cierra su socket"""
+        with self.lock:
+            if child in self.children:
+                self.children.remove(child)
+        self.hang_up(child)
+    
+    def hang_up(self, sock):
+        """
+        Cierra un socket avisando al otro extremo
+        Sin shutdown(), close() no despierta al hilo bloqueado en recv()
+        y el otro extremo nunca ve el fin de la conexión
+        """
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            sock.close()
+        except OSError:
+            pass
+    
+    def attach(self, ip, port):
+        """
+        Cambia de padre; con ip None se recibe directo del host
+        Puede tardar (conexión de red), así que no se llama desde el hilo del host
+        """
+        with self.lock:
+            self.attach_generation += 1
+            generation = self.attach_generation
+            old_parent, self.parent_socket = self.parent_socket, None
+        if old_parent:
+            self.hang_up(old_parent)
+        
+        if ip is None:
+            return True
+        
+        try:
+            parent = socket.create_connection((ip, port), timeout=5)
+            parent.sendall(f"{self.key}\n".encode('utf-8'))
+            if parent.recv(1) != b"\n":
+                parent.close()
+                return False
+            parent.settimeout(None)
+        except OSError:
+            return False
+        
+        with self.lock:
+            if generation != self.attach_generation:
+                # Llegó otra asignación mientras nos conectábamos
+                parent.close()
+                return False
+            self.parent_socket = parent
+        threading.Thread(target=self.read_parent, args=(parent,), daemon=True).start()
+        return True
+    
+    def read_parent(self, parent):
+        """Hilo que recibe los broadcasts reenviados por el padre"""
+        buffer = ""
+        try:
+            while self.running:
+                data = parent.recv(4096).decode('utf-8')
+                if not data:
+                    break
+                
+                buffer += data
+                while '\n' in buffer:
+                    line, buffer = buffer.split('\n', 1)
+                    if line:
+                        try:
+                            self.deliver(line, json.loads(line), from_parent=True)
+                        except json.JSONDecodeError:
+                            continue
+        except:
+            pass
+        
+        # Si este seguía siendo el padre, el enlace se cayó sin reasignación
+        with self.lock:
+            lost = self.running and parent is self.parent_socket
+            if lost:
+                self.parent_socket = None
+        try:
+            parent.close()
+        except:
+            pass
+        if lost and self.on_parent_lost:
+            self.on_parent_lost()
+    
+    def deliver(self, line, message, from_parent=False):
+        """Encola un broadcast recibido del host o del padre para entregarlo en orden"""
+        if not isinstance(message, dict) or type(message.get("seq")) is not int:
+            return
+        if from_parent and message.get("type") not in self.RELAYED_TYPES:
+            return  # Solo el host puede enviar mensajes de control
+        self.inbox.put((line, message))
+    
+    def delivery_loop(self):
+        """Hilo único que ordena los broadcasts, los reenvía y los procesa"""
+        while self.running:
+            try:
+                line, message = self.inbox.get(timeout=0.5)
+                self.hold(line, message)
+            except queue.Empty:
+                pass
+            for line, message in self.release():
+                self.dispatch(line, message)
+    
+    def hold(self, line, message):
+        """Guarda un broadcast nuevo hasta que le toque; descarta duplicados"""
+        seq = message["seq"]
+        if self.contiguous is None:
+            self.contiguous = seq - 1
+        if seq <= self.contiguous or seq in self.held:
+            return
+        self.held[seq] = (line, message)
+    
+    def release(self):
+        """Devuelve los broadcasts que ya se pueden entregar sin saltarse ninguno"""
+        ready = []
+        while True:
+            while self.contiguous is not None and self.contiguous + 1 in self.held:
+                self.contiguous += 1
+                ready.append(self.held.pop(self.contiguous))
+                self.gap_since = None
+            
+            if not self.held:
+                self.gap_since = None
+                return ready
+            if self.gap_since is None:
+                self.gap_since = time.monotonic()
+                return ready
+            if (time.monotonic() - self.gap_since < self.gap_timeout
+                    and len(self.held) < self.window):
+                return ready
+            # Hueco que ya no se va a llenar: se salta
+            self.contiguous = min(self.held) - 1
+    
+    def dispatch(self, line, message):
+        """Reenvía a los hijos (solo tipos retransmitibles) y procesa localmente"""
+        if message.get("type") in self.RELAYED_TYPES:
+            with self.lock:
+                children = self.children[:]
+            data = (line + '\n').encode('utf-8')
+            for child in children:
+                try:
+                    child.sendall(data)
+                except:
+                    self.drop_child(child)
+        
+        try:
+            self.on_message(message)
+        except Exception as e:
+            print(f"DEBUG: Error procesando broadcast: {e}")
+    
+    def last_contiguous(self):
+        """Último seq recibido sin huecos antes (-1 si aún no llegó ninguno)"""
+        contiguous = self.contiguous
+        return contiguous if contiguous is not None else -1
+    
+    def close(self):
+        """Cierra todas las conexiones del relay"""
+        self.running = False
+        sockets = [self.listen_socket, self.parent_socket] + self.children
+        for sock in sockets:
+            if sock:
+                self.hang_up(sock)
+
+
+class GameHistory:
+    """
+    Historial persistente de partidas en SQLite (modo WAL)
+    Las escrituras se encolan y un hilo las guarda por lotes,
+    así el hilo que procesa mensajes nunca espera al disco
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rounds (
+            id TEXT PRIMARY KEY,
+            session TEXT NOT NULL,
+            number INTEGER NOT NULL,
+            drawer TEXT NOT NULL,
+            word TEXT NOT NULL,
+            guessers INTEGER NOT NULL,
+            started_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS guesses (
+            round_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            seconds REAL NOT NULL,
+            guessed_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS final_scores (
+            session TEXT NOT NULL,
+            name TEXT NOT NULL,
+            points INTEGER NOT NULL,
+            recorded_at REAL NOT NULL,
+            PRIMARY KEY (session, name)
+        );
+        CREATE INDEX IF NOT EXISTS idx_rounds_word ON rounds (word);
+        CREATE INDEX IF NOT EXISTS idx_guesses_round ON guesses (round_id);
+        CREATE INDEX IF NOT EXISTS idx_final_scores_name ON final_scores (name);
+    """
+    
+    def __init__(self, path="paint3_history.db", batch_size=100, flush_interval=0.5):
+        """Crea el esquema si no existe e inicia el hilo escritor"""
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue()
+        
+        self.read_conn = sqlite3.connect(path, check_same_thread=False)
+        self.read_conn.execute("PRAGMA journal_mode=WAL")
+        self.read_conn.executescript(self.SCHEMA)
+        self.read_lock = threading.Lock()
+        
+        self.writer_thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer_thread.start()
+    
+    def write_loop(self):
+        """Hilo escritor: agrupa las operaciones encoladas en una transacción"""
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        stop = False
+        while not stop:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            stop = None in batch
+            batch = [item for item in batch if item is not None]
+            try:
+                with conn:
+                    for sql, params in batch:
+                        conn.execute(sql, params)
+            except sqlite3.Error as e:
+                print(f"DEBUG: Error guardando historial: {e}")
+        conn.close()
+    
+    def record_round(self, round_id, session, number, drawer, word, guessers):
+        """Registra el inicio de una ronda"""
+        self.pending.put((
+            "INSERT OR REPLACE INTO rounds VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (round_id, session, number, drawer, word, guessers, time.time())))
+    
+    def record_guess(self, round_id, name, seconds):
+        """Registra un acierto con el tiempo que tardó desde el inicio de la ronda"""
+        self.pending.put((
+            "INSERT INTO guesses VALUES (?, ?, ?, ?)",
+            (round_id, name, seconds, time.time())))
+    
+    def record_scores(self, session, scores):
+        """Guarda (o actualiza) los puntajes finales de la sesión"""
+        now = time.time()
+        for name, points in scores.items():
+            self.pending.put((
+                "INSERT OR REPLACE INTO final_scores VALUES (?, ?, ?, ?)",
+                (session, name, points, now)))
+    
+    def leaderboard(self, limit=10):
+        """Ranking histórico: [(nombre, puntos totales, sesiones jugadas)]"""
+        with self.read_lock:
+            return self.read_conn.execute(
+                "SELECT name, SUM(points) AS total, COUNT(*) FROM final_scores "
+                "GROUP BY name ORDER BY total DESC LIMIT ?", (limit,)).fetchall()
+    
+    def word_stats(self, words):
+        """
+        Estadísticas de las palabras dadas
+        Devuelve {palabra: (rondas, tasa de acierto, segundos promedio o None)}
+        Solo recorre las rondas de esas palabras (índices de word y round_id)
+        """
+        words = list(set(words))
+        if not words:
+            return {}
+        placeholders = ", ".join("?" * len(words))
+        with self.read_lock:
+            rows = self.read_conn.execute(
+                "SELECT r.word, COUNT(*), SUM(r.guessers), "
+                "    SUM((SELECT COUNT(*) FROM guesses g WHERE g.round_id = r.id)), "
+                "    SUM((SELECT SUM(g.seconds) FROM guesses g WHERE g.round_id = r.id)) "
+                f"FROM rounds r WHERE r.word IN ({placeholders}) GROUP BY r.word",
+                words).fetchall()
+        
+        stats = {}
+        for word, rounds, guessers, hits, seconds in rows:
+            rate = (hits or 0) / guessers if guessers else 0.0
+            stats[word] = (rounds, min(rate, 1.0), seconds / hits if hits else None)
+        return stats
+    
+    def pick_word(self, words):
+        """
+        Elige una palabra favoreciendo las de dificultad media
+        Las que nadie adivina o que todos adivinan salen menos
+        """
+        stats = self.word_stats(words)
+        weights = []
+        for word in words:
+            if word in stats:
+                rate = stats[word][1]
+                weights.append(0.25 + 3 * rate * (1 - rate))
+            else:
+                weights.append(1.0)  # Palabras nuevas con peso normal
+        return random.choices(words, weights=weights)[0]
+    
+    def close(self):
+        """Vacía la cola pendiente y cierra las conexiones"""
+        self.pending.put(None)
+        self.writer_thread.join(timeout=5)
+        with self.read_lock:
+            self.read_conn.close()
+
+
+class JitterBuffer:
+    """
+    Buffer de reproducción para los trazos remotos
+    Cada operación trae la marca de tiempo del dibujante ("t", en ms) y se
+    reproduce con el mismo ritmo con el que fue dibujada, más un retraso
+    que se adapta a la variación de la red. Si la reproducción queda
+    atrasada (p. ej. tras una pausa de la red), avanza más rápido que el
+    tiempo real hasta volver al retraso objetivo
+    """
+    
+    def __init__(self, delay_ms=60, min_delay_ms=20, max_delay_ms=400,
+                 catchup_speed=2.0, max_lag_ms=3000):
+        """
+        Inicializa el buffer con un retraso inicial configurable
+        catchup_speed: velocidad de reproducción mientras está atrasado
+        max_lag_ms: atraso máximo; lo que exceda se dibuja de golpe
+        """
+        if max_lag_ms <= max_delay_ms:
+            raise ValueError("max_lag_ms debe ser mayor que max_delay_ms")
+        self.initial_delay = delay_ms
+        self.min_delay = min_delay_ms
+        self.max_delay = max_delay_ms
+        self.catchup_speed = catchup_speed
+        self.max_lag = max_lag_ms
+        self.lock = threading.Lock()
+        self.underruns = 0
+        self.catchups = 0
+        self.reset()
+    
+    def reset(self):
+        """Vacía el buffer (nueva ronda o nuevo dibujante)"""
+        with self.lock:
+            self.queue = deque()  # (marca de tiempo del emisor, mensaje)
+            self.delay = self.initial_delay
+            self.offset = None  # Menor (llegada - emisión) observado
+            self.last_transit = None
+            self.jitter = 0.0
+            self.cursor = None  # Hasta qué marca del emisor se reprodujo
+            self.newest = None  # Marca más reciente recibida
+            self.last_pop = None
+            self.lag = 0.0  # Atraso respecto al retraso objetivo (ms)
+            self.catching_up = False
+    
+    def push(self, message, now):
+        """Encola una operación recibida en el instante local now (ms)"""
+        with self.lock:
+            t = message.get("t")
+            if t is None:
+                # Mensaje sin marca de tiempo: se reproduce tras el retraso actual
+                t = now - (self.offset or 0)
+            if self.newest is not None:
+                t = max(t, self.newest)  # Se reproduce en orden de llegada
+            
+            transit = now - t
+            if self.offset is None or transit < self.offset:
+                self.offset = transit
+            
+            # Estimación de jitter al estilo RFC 3550
+            if self.last_transit is not None:
+                self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+            self.last_transit = transit
+            
+            target = now - self.offset - self.delay
+            if not self.queue:
+                late = target - t
+                if late > 0 and self.newest is not None:
+                    # El buffer se vació y esto llegó tarde: underrun.
+                    # Se reproduce desde aquí y se agranda el retraso
+                    self.underruns += 1
+                    self.delay = min(self.max_delay, self.delay + late / 4)
+                elif late <= 0:
+                    # Enlace estable: el retraso baja poco a poco hacia el mínimo
+                    jitter_target = max(self.min_delay, 3 * self.jitter)
+                    if jitter_target < self.delay:
+                        self.delay -= (self.delay - jitter_target) / 32
+                # Tras una pausa del dibujante el cursor salta al presente
+                start = min(target, t)
+                self.cursor = start if self.cursor is None else max(self.cursor, start)
+            else:
+                jitter_target = max(self.min_delay, 3 * self.jitter)
+                if jitter_target < self.delay and t >= target:
+                    self.delay -= (self.delay - jitter_target) / 32
+            
+            self.queue.append((t, message))
+            self.newest = t
+    
+    def pop_due(self, now):
+        """Devuelve, en orden, las operaciones cuyo momento ya llegó"""
+        due = []
+        with self.lock:
+            elapsed = now - self.last_pop if self.last_pop is not None else 0
+            self.last_pop = now
+            if not self.queue:
+                return due
+            
+            target = now - self.offset - self.delay
+            self.lag = target - self.cursor
+            if self.lag > self.max_lag:
+                # Demasiado atrasado: se salta el exceso
+                self.cursor = target - self.max_lag
+                self.lag = self.max_lag
+            
+            if not self.catching_up and self.lag > self.delay:
+                # Atrasado más que el retraso objetivo: empieza la recuperación
+                self.catching_up = True
+                self.catchups += 1
+            elif self.catching_up and self.lag <= elapsed:
+                self.catching_up = False
+            
+            # Mientras se recupera se reproduce más rápido que el tiempo real
+            step = elapsed * (self.catchup_speed if self.catching_up else 1)
+            # El cursor nunca pasa del objetivo ni de lo ya recibido
+            self.cursor = max(self.cursor, min(target, self.cursor + step, self.newest))
+            
+            while self.queue and self.queue[0][0] <= self.cursor:
+                due.append(self.queue.popleft()[1])
+        return due
+    
+    def stats(self):
+        """Retraso (ms), atraso, operaciones en espera y conteos de underruns/recuperaciones"""
+        with self.lock:
+            return {"delay_ms": self.delay, "lag_ms": max(0.0, self.lag),
+                    "queued": len(self.queue), "underruns": self.underruns,
+                    "catchups": self.catchups}
+
+
+class TokenBucket:
+    """Cubeta de tokens: se recarga a rate tokens/seg hasta burst; consumir es O(1)"""
+    
+    __slots__ = ("rate", "burst", "tokens", "last")
+    
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+    
+    def consume(self, now, amount=1):
+        """Intenta gastar amount tokens; devuelve False si no alcanzan"""
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+
+class PeerRateLimiter:
+    """
+    Límites por tipo de mensaje para un peer (host)
+    El dibujo excedente se submuestrea, el resto se descarta y cada
+    descarte suma faltas; quien agota sus faltas es desconectado.
+    Los límites sin faltas (None) nunca descartan: se pasa o se desconecta
+    """
+    
+    def __init__(self, limits, max_strikes, stats, kinds=None):
+        """
+        limits: {cubeta: (tokens por segundo, ráfaga, faltas por descarte o None)}
+        con "default" para los tipos no listados
+        kinds: {tipo: cubeta} para que varios tipos compartan una cubeta
+        stats: diccionario compartido con los contadores del host
+        """
+        now = time.monotonic()
+        self.limits = limits
+        self.kinds = kinds or {}
+        self.buckets = {}
+        self.strikes = TokenBucket(1, max_strikes, now)  # Se perdona una falta por segundo
+        self.pending_start = None  # (trazo, x1, y1) del primer segmento descartado
+        self.stats = stats
+    
+    def check(self, message, now):
+        """Devuelve ("allow", mensaje), ("drop", None) o ("disconnect", None)"""
+        # Lo que no es un mensaje con tipo de texto se descarta sin procesar
+        if not isinstance(message, dict) or not isinstance(message.get("type"), str):
+            self.stats["dropped"] += 1
+            return self.strike("default", now)
+        
+        # Los tipos no listados comparten la cubeta "default"
+        msg_type = message["type"]
+        kind = self.kinds.get(msg_type, msg_type)
+        if kind not in self.limits:
+            kind = "default"
+        bucket = self.buckets.get(kind)
+        if bucket is None:
+            rate, burst, _ = self.limits[kind]
+            bucket = self.buckets[kind] = TokenBucket(rate, burst, now)
+        
+        if bucket.consume(now):
+            if kind == "draw" and self.pending_start:
+                # Une los segmentos descartados al siguiente para no dejar huecos
+                stroke, x1, y1 = self.pending_start
+                self.pending_start = None
+                if stroke == message.get("stroke"):
+                    message = dict(message, x1=x1, y1=y1)
+            self.stats["allowed"] += 1
+            return "allow", message
+        
+        if kind == "draw":
+            if (not self.pending_start
+                    or self.pending_start[0] != message.get("stroke")):
+                self.pending_start = (message.get("stroke"),
+                                      message.get("x1"), message.get("y1"))
+            self.stats["downsampled"] += 1
+        elif self.limits[kind][2] is not None:
+            self.stats["dropped"] += 1
+        
+        return self.strike(kind, now)
+    
+    def strike(self, kind, now):
+        """Suma las faltas de un descarte; sin faltas disponibles, desconectar"""
+        cost = self.limits[kind][2]
+        if cost is None or not self.strikes.consume(now, cost):
+            self.stats["disconnected"] += 1
+            return "disconnect", None
+        return "drop", None
+
+
 class Paint3:
     """
     Clase principal del juego Paint 3 con arquitectura P2P
@@ -23,11 +747,15 @@ class Paint3:
     """
     
     def __init__(self, root):
-        """Inicializa la app y sus componentes"""
+        """
+        Inicializa la app y sus componentes
+        Con root None funciona sin interfaz (solo red), p. ej. en bench_relay.py
+        """
         self.root = root
-        self.root.title("Paint 3")
-        self.root.geometry("1200x700")
-        self.root.resizable(False, False)
+        if self.root is not None:
+            self.root.title("Paint 3")
+            self.root.geometry("1200x700")
+            self.root.resizable(False, False)
         
         # Variables de red
         self.peer_socket = None
@@ -37,6 +765,37 @@ class Paint3:
         self.my_port = None
         self.my_name = "Jugador"
         
+        # Árbol de retransmisión (opcional)
+        self.relay_tree = None  # Solo host, None = topología estrella
+        self.relay_node = None  # Solo cliente
+        self.relay_key = None  # Solo host, clave que los hijos presentan a su relay
+        self.broadcast_seq = 0
+        self.broadcast_lock = threading.Lock()  # Broadcast llega desde varios hilos
+        self.broadcast_sends = 0  # Envíos hechos por el host (estadística)
+        self.recent_broadcasts = deque(maxlen=256)  # (seq, mensaje) para reponer huecos
+        
+        # Límites de mensajes por peer (host): {cubeta: (por segundo, ráfaga, faltas)}
+        # Deshacer/rehacer cambian el estado del canvas: descartarlos lo
+        # desincroniza, así que su cubeta (holgada para la repetición de
+        # teclas de Ctrl+Z) no tiene faltas y al excederla se desconecta
+        self.rate_limits = {
+            "draw": (150, 300, 0.02),
+            "canvas": (40, 120, None),
+            "chat": (2, 5, 1),
+            "correct_guess": (1, 2, 1),
+            "relay_resync": (0.2, 2, 1),
+            "relay_detached": (1, 5, 1),
+            "default": (10, 20, 1),
+        }
+        self.rate_kinds = {"undo": "canvas", "redo": "canvas",
+                           "discard": "canvas", "clear": "canvas"}
+        self.max_strikes = 20
+        self.max_line_length = 65536
+        self.rate_stats = {"allowed": 0, "downsampled": 0, "dropped": 0,
+                           "disconnected": 0, "checks": 0, "check_time": 0.0}
+        self.peer_names = {}  # {socket: nombre con el que hizo join}
+        self.round_guessers = set()  # Quienes ya acertaron esta ronda
+        
         # Variables del juego
         self.game_active = False
         self.current_drawer = None  # Nombre del jugador que dibuja
@@ -45,6 +804,11 @@ class Paint3:
         self.time_left = 0
         self.round_number = 0
         self.max_rounds = 3
+        self.round_started_at = 0
+        
+        # Historial persistente (solo host)
+        self.history = None
+        self.session_id = None
         
         # Palabras para el juego
         self.word_bank = [
@@ -65,12 +829,24 @@ class Paint3:
         self.color = "black"
         self.brush_size = 3
         
+        # Reproducción de trazos remotos
+        self.jitter_buffer = JitterBuffer(delay_ms=60)
+        self.playback_interval = 10  # ms entre revisiones del buffer
+        
+        # Historial de trazos para deshacer/rehacer
+        self.stroke_counter = 0
+        self.current_stroke = None  # Id del trazo en curso
+        self.undo_stack = []  # Ids de trazos terminados
+        self.redo_stack = []  # Ids de trazos deshechos
+        
         # Control de hilos
         self.running = True
         self.timer_thread = None
         
         # Construir interfaz
-        self.setup_ui()
+        if self.root is not None:
+            self.setup_ui()
+            self.root.after(self.playback_interval, self.play_buffered_strokes)
         
     def setup_ui(self):
         """Construye la interfaz grafica de usuario"""
@@ -131,9 +907,21 @@ class Paint3:
         tk.Button(self.tools_frame, text="Limpiar", command=self.clear_canvas,
                  bg="#95A5A6", fg="white", font=("Arial", 10, "bold")).pack(side=tk.LEFT, padx=5)
         
+        tk.Button(self.tools_frame, text="Deshacer", command=self.undo_stroke,
+                 bg="#95A5A6", fg="white", font=("Arial", 10, "bold")).pack(side=tk.LEFT, padx=5)
+        
+        tk.Button(self.tools_frame, text="Rehacer", command=self.redo_stroke,
+                 bg="#95A5A6", fg="white", font=("Arial", 10, "bold")).pack(side=tk.LEFT, padx=5)
+        
+        self.stats_label = tk.Label(self.tools_frame, text="", bg="#ECF0F1",
+                                    fg="#7F8C8D", font=("Arial", 8))
+        self.stats_label.pack(side=tk.RIGHT, padx=5)
+        
         # Eventos del canvas
         self.canvas.bind("<B1-Motion>", self.paint)
         self.canvas.bind("<ButtonRelease-1>", self.reset)
+        self.root.bind("<Control-z>", self.undo_stroke)
+        self.root.bind("<Control-y>", self.redo_stroke)
         
         # Panel derecho - Chat y conexión
         self.right_panel = tk.Frame(self.main_frame, bg="#34495E", width=300)
@@ -163,6 +951,12 @@ class Paint3:
         self.port_entry.insert(0, "5555")
         self.port_entry.pack(fill=tk.X, padx=5, pady=2)
         
+        tk.Label(connection_frame, text="Relays por nodo (0 = estrella):", 
+                bg="#34495E", fg="white").pack(anchor=tk.W, padx=5)
+        self.fanout_entry = tk.Entry(connection_frame)
+        self.fanout_entry.insert(0, "0")
+        self.fanout_entry.pack(fill=tk.X, padx=5, pady=2)
+        
         tk.Button(connection_frame, text="Conectar como Cliente", 
                  command=self.connect_to_host, bg="#3498DB", fg="white").pack(fill=tk.X, padx=5, pady=2)
         
@@ -194,22 +988,15 @@ class Paint3:
             
         try:
             port = int(self.port_entry.get())
-            self.my_port = port
-            self.is_host = True
-            
-            # Crear socket servidor
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind(("0.0.0.0", port))
-            self.server_socket.listen(5)
-            
-            # Agregar a la lista de jugadores
-            self.scores[self.my_name] = 0
-            self.update_players_list()
+            fanout = int(self.fanout_entry.get() or 0)
+            self.open_room(port, fanout)
             
-            # Hilo para aceptar conexiones
-            accept_thread = threading.Thread(target=self.accept_connections, daemon=True)
-            accept_thread.start()
+            # Historial de partidas; el juego sigue sin él si falla
+            self.session_id = f"{int(time.time())}-{port}"
+            try:
+                self.history = GameHistory()
+            except sqlite3.Error as e:
+                print(f"DEBUG: Historial deshabilitado: {e}")
             
             # Obtener IP local
             local_ip = socket.gethostbyname(socket.gethostname())
@@ -221,6 +1008,13 @@ class Paint3:
             self.add_chat_message("SISTEMA", "Comparte estos datos con otros jugadores:")
             self.add_chat_message("SISTEMA", f"IP: {local_ip}  |  Puerto: {port}")
             
+            if self.history:
+                top = self.history.leaderboard(3)
+                if top:
+                    self.add_chat_message("SISTEMA", "Ranking histórico:")
+                    for position, (name, total, _) in enumerate(top, 1):
+                        self.add_chat_message("SISTEMA", f"{position}. {name}: {total} pts")
+            
             # Mostrar ventana emergente con la información
             self.show_connection_info(local_ip, port)
             
@@ -229,6 +1023,29 @@ class Paint3:
         except Exception as e:
             messagebox.showerror("Error", f"No se pudo crear la sala: {e}")
     
+    def open_room(self, port, fanout=0, bind_ip="0.0.0.0"):
+        """Abre el socket servidor y empieza a aceptar peers (parte de red del host)"""
+        self.is_host = True
+        
+        if fanout > 0:
+            self.relay_tree = RelayTree(fanout)
+            self.relay_key = secrets.token_hex(16)
+        
+        # Crear socket servidor
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((bind_ip, port))
+        self.server_socket.listen(128)
+        self.my_port = self.server_socket.getsockname()[1]
+        
+        # Agregar a la lista de jugadores
+        self.scores[self.my_name] = 0
+        self.update_players_list()
+        
+        # Hilo para aceptar conexiones
+        accept_thread = threading.Thread(target=self.accept_connections, daemon=True)
+        accept_thread.start()
+    
     def show_connection_info(self, ip, port):
         """Muestra una ventana con la información de conexión del host"""
         info_window = tk.Toplevel(self.root)
@@ -317,25 +1134,34 @@ class Paint3:
         try:
             host_ip = self.host_ip_entry.get()
             port = int(self.port_entry.get())
-            
-            self.peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.peer_socket.connect((host_ip, port))
-            
-            # Enviar nombre al host
-            self.send_data({"type": "join", "name": self.my_name})
-            
-            # Hilo para recibir datos
-            receive_thread = threading.Thread(target=self.receive_data, daemon=True)
-            receive_thread.start()
+            self.join_host(host_ip, port)
             
             self.add_chat_message("SISTEMA", f"Conectado al host {host_ip}:{port}")
             
         except Exception as e:
             messagebox.showerror("Error", f"No se pudo conectar: {e}")
     
+    def join_host(self, host_ip, port):
+        """Se conecta al host y envía el join (parte de red del cliente)"""
+        self.peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.peer_socket.connect((host_ip, port))
+        
+        # Descarta broadcasts duplicados; solo escucha hijos si el host usa árbol
+        self.relay_node = RelayNode(lambda message: self.process_message(message, None),
+                                    self.relay_parent_lost)
+        
+        # Enviar nombre al host
+        self.send_data({"type": "join", "name": self.my_name})
+        
+        # Hilo para recibir datos
+        receive_thread = threading.Thread(target=self.receive_data, daemon=True)
+        receive_thread.start()
+    
     def handle_peer(self, peer_socket):
         """Maneja la comunicación con un peer conectado"""
         buffer = ""
+        limiter = PeerRateLimiter(self.rate_limits, self.max_strikes, self.rate_stats,
+                                  self.rate_kinds)
         try:
             while self.running:
                 data = peer_socket.recv(4096).decode('utf-8')
@@ -343,20 +1169,42 @@ class Paint3:
                     break
                     
                 buffer += data
+                if len(buffer) > self.max_line_length and '\n' not in buffer:
+                    self.add_chat_message("SISTEMA", "Peer desconectado: mensaje demasiado largo")
+                    return
+                
                 while '\n' in buffer:
                     line, buffer = buffer.split('\n', 1)
                     if line:
                         try:
                             message = json.loads(line)
-                            self.process_message(message, peer_socket)
                         except json.JSONDecodeError:
                             continue
                         
+                        # Límite de tasa antes de procesar
+                        start = time.perf_counter()
+                        action, message = limiter.check(message, time.monotonic())
+                        self.rate_stats["check_time"] += time.perf_counter() - start
+                        self.rate_stats["checks"] += 1
+                        
+                        if action == "disconnect":
+                            name = self.peer_names.get(peer_socket, "Un peer")
+                            self.add_chat_message("SISTEMA", 
+                                f"{name} fue desconectado por exceso de mensajes")
+                            return
+                        if action == "allow":
+                            self.process_message(message, peer_socket)
+                        
         except Exception as e:
             self.add_chat_message("SISTEMA", f"Error con peer: {e}")
         finally:
             if peer_socket in self.connected_peers:
                 self.connected_peers.remove(peer_socket)
+            self.peer_names.pop(peer_socket, None)
+            if self.relay_tree:
+                # Reasignar a los hijos huérfanos si era relay
+                self.relay_tree.remove(peer_socket)
+                self.update_relay_tree()
             peer_socket.close()
     
     def receive_data(self):
@@ -378,7 +1226,11 @@ class Paint3:
                             msg_type = message.get('type')
                             if msg_type != 'draw':
                                 print(f"DEBUG receive_data: Cliente recibió {msg_type}")
-                            self.process_message(message, None)
+                            if "seq" in message:
+                                # Broadcast: se descartan duplicados y se reenvía a los hijos
+                                self.relay_node.deliver(line, message)
+                            else:
+                                self.process_message(message, None)
                         except json.JSONDecodeError as e:
                             print(f"DEBUG: Error JSON: {e}")
                             continue
@@ -400,10 +1252,68 @@ class Paint3:
             
             # Host envia la lista actualizada a todos
             if self.is_host:
+                self.peer_names[sender_socket] = name
+                if self.relay_tree:
+                    # Pedir al peer que abra su puerto de relay
+                    self.send_data_to_peer(sender_socket,
+                        {"type": "relay_enable", "key": self.relay_key})
                 self.broadcast_data({"type": "player_list", "players": self.scores})
                 self.send_data_to_peer(sender_socket, 
                     {"type": "player_list", "players": self.scores})
         
+        elif msg_type == "relay_enable":
+            # El host usa árbol de relays: abrir puerto para posibles hijos
+            if self.relay_node and not self.relay_node.listen_socket:
+                try:
+                    port = self.relay_node.start(message.get("key"))
+                except OSError:
+                    return
+                self.send_data({"type": "relay_port", "port": port})
+        
+        elif msg_type == "relay_port":
+            # El peer ya escucha hijos, se agrega al árbol
+            if self.is_host and self.relay_tree and sender_socket in self.connected_peers:
+                ip = sender_socket.getpeername()[0]
+                self.relay_tree.add(sender_socket, ip, message.get("port"))
+                self.update_relay_tree()
+        
+        elif msg_type == "relay_parent":
+            # El host nos asigna un nuevo padre en el árbol de retransmisión
+            if self.relay_node:
+                threading.Thread(target=self.attach_relay_parent, 
+                                 args=(message.get("ip"), message.get("port")),
+                                 daemon=True).start()
+        
+        elif msg_type == "relay_resync":
+            # El peer cambió de padre: reponer los broadcasts que pudo perder
+            if self.is_host and sender_socket in self.connected_peers:
+                since = message.get("since")
+                if not isinstance(since, int):
+                    return
+                with self.broadcast_lock:
+                    missed = [line for seq, line in self.recent_broadcasts if seq > since]
+                for line in missed:
+                    try:
+                        sender_socket.send(line.encode('utf-8'))
+                        self.broadcast_sends += 1
+                    except:
+                        break
+        
+        elif msg_type == "relay_detached":
+            # Se cayó el enlace con su relay: vuelve a recibir directo y reintenta
+            if self.is_host and self.relay_tree:
+                parent = self.relay_tree.detached(sender_socket)
+                if parent:
+                    self.send_data_to_peer(sender_socket,
+                        {"type": "relay_parent", "ip": parent[0], "port": parent[1]})
+                self.update_relay_tree()
+        
+        elif msg_type == "relay_attached":
+            # Un peer ya recibe de su relay, el host deja de enviarle directo
+            if self.is_host and self.relay_tree:
+                self.relay_tree.attached(sender_socket, message.get("ip"),
+                                         message.get("port"))
+        
         elif msg_type == "player_list":
             # Actualizar lista de jugadores
             self.scores = message.get("players", {})
@@ -429,8 +1339,12 @@ class Paint3:
                 print(f"DEBUG: Soy quien adivina, palabra guardada: {self.current_word}")
             
             self.time_left = 60
+            self.round_started_at = time.time()
+            self.round_guessers.clear()
             self.game_active = True
+            self.jitter_buffer.reset()
             self.clear_canvas()
+            self.reset_stroke_history()
             
             if not self.timer_thread or not self.timer_thread.is_alive():
                 self.timer_thread = threading.Thread(target=self.game_timer, daemon=True)
@@ -439,20 +1353,14 @@ class Paint3:
             self.add_chat_message("SISTEMA", 
                 f"Ronda {self.round_number}: {self.current_drawer} está dibujando")
         
-        elif msg_type == "draw":
-            # Recibir trazo de dibujo
-            if not self.am_i_drawing:
-                x1, y1 = message.get("x1"), message.get("y1")
-                x2, y2 = message.get("x2"), message.get("y2")
-                color = message.get("color")
-                size = message.get("size")
-                self.canvas.create_line(x1, y1, x2, y2, 
-                                       fill=color, width=size, 
-                                       capstyle=tk.ROUND, smooth=True)
-        
-        elif msg_type == "clear":
-            # Limpiar canvas
-            self.canvas.delete("all")
+        elif msg_type in ("draw", "undo", "redo", "discard", "clear"):
+            # Operaciones del canvas: se reproducen al ritmo del dibujante.
+            # El host solo las acepta del socket del dibujante actual
+            if sender_socket is not None and \
+                    self.peer_names.get(sender_socket) != self.current_drawer:
+                return
+            if not self.am_i_drawing and self.valid_canvas_op(message):
+                self.jitter_buffer.push(message, self.timestamp_ms())
         
         elif msg_type == "chat":
             # Mensaje de chat (solo se recibe si NO es respuesta correcta)
@@ -468,8 +1376,19 @@ class Paint3:
             print(f"DEBUG: Host recibió correct_guess de {name}")
             print(f"DEBUG: Puntajes recibidos: {received_scores}")
             
-            # Actualizar puntajes en el host
-            if received_scores:
+            if self.is_host:
+                # El host no confía en el nombre ni en los puntajes del cliente:
+                # solo cuenta el nombre con el que ese socket hizo join
+                if sender_socket not in self.peer_names:
+                    return
+                name = self.peer_names[sender_socket]
+                if (not self.game_active or name == self.current_drawer
+                        or name in self.round_guessers):
+                    return
+                self.round_guessers.add(name)
+            
+            # Actualizar puntajes
+            if received_scores and not self.is_host:
                 self.scores = received_scores
             else:
                 if name not in self.scores:
@@ -482,6 +1401,7 @@ class Paint3:
             if self.is_host:
                 print(f"DEBUG: Host anunciando que {name} adivinó")
                 self.add_chat_message("SISTEMA", f"¡{name} adivinó la palabra!")
+                self.record_guess(name)
                 
                 # Reenviar a TODOS los clientes para que vean la actualización
                 broadcast_msg = {
@@ -523,14 +1443,47 @@ class Paint3:
                 pass
     
     def broadcast_data(self, data):
-        """Transmite datos a todos los peers conectados (host)"""
+        """
+        Transmite datos a todos los peers conectados (host)
+        Con árbol de relays el dibujo y el chat se envían solo a las raíces y
+        a los peers pendientes; los mensajes de control van directo a todos
+        """
         if self.is_host:
-            message = json.dumps(data) + '\n'
-            for peer in self.connected_peers[:]:  # Copia para evitar modificación durante iteración
+            with self.broadcast_lock:
+                self.broadcast_seq += 1
+                seq = self.broadcast_seq
+                message = json.dumps(dict(data, seq=seq)) + '\n'
+                self.recent_broadcasts.append((seq, message))
+            targets = self.connected_peers[:]  # Copia para evitar modificación durante iteración
+            if self.relay_tree and data.get("type") in RelayNode.RELAYED_TYPES:
+                targets = self.relay_tree.direct_targets(targets)
+            for peer in targets:
                 try:
                     peer.send(message.encode('utf-8'))
+                    self.broadcast_sends += 1
                 except:
-                    self.connected_peers.remove(peer)
+                    if peer in self.connected_peers:
+                        self.connected_peers.remove(peer)
+    
+    def attach_relay_parent(self, ip, port):
+        """Hilo que se conecta al nuevo padre sin frenar los mensajes del host"""
+        if not self.relay_node.attach(ip, port):
+            return
+        if ip is not None:
+            self.send_data({"type": "relay_attached", "ip": ip, "port": port})
+        
+        # Lo enviado mientras el padre anterior se caía no llegó: pedirlo al host
+        self.send_data({"type": "relay_resync", "since": self.relay_node.last_contiguous()})
+    
+    def relay_parent_lost(self):
+        """Se cayó el enlace con el padre: avisar al host y pedir lo perdido"""
+        self.send_data({"type": "relay_detached"})
+        self.send_data({"type": "relay_resync", "since": self.relay_node.last_contiguous()})
+    
+    def update_relay_tree(self):
+        """Recalcula el árbol y avisa a cada peer cuyo padre cambió (host)"""
+        for peer, ip, port in self.relay_tree.rebuild():
+            self.send_data_to_peer(peer, {"type": "relay_parent", "ip": ip, "port": port})
     
     def start_game(self):
         """Inicia una nueva ronda del juego (solo host)"""
@@ -548,8 +1501,11 @@ class Paint3:
         self.current_drawer = random.choice(players)
         self.am_i_drawing = (self.current_drawer == self.my_name)
         
-        # Seleccionar palabra aleatoria
-        self.current_word = random.choice(self.word_bank)
+        # Seleccionar palabra (ponderada por dificultad si hay historial)
+        if self.history:
+            self.current_word = self.history.pick_word(self.word_bank)
+        else:
+            self.current_word = random.choice(self.word_bank)
         
         print(f"DEBUG start_game (HOST): round={self.round_number}, drawer={self.current_drawer}, word={self.current_word}")
         
@@ -563,6 +1519,11 @@ class Paint3:
         
         print(f"DEBUG: Host enviando start_game a todos: {game_data}")
         
+        if self.history:
+            self.history.record_round(self.current_round_id(), self.session_id,
+                                      self.round_number, self.current_drawer,
+                                      self.current_word, len(self.scores) - 1)
+        
         # Transmitir a todos los clientes
         self.broadcast_data(game_data)
         
@@ -588,17 +1549,36 @@ class Paint3:
                 self.add_chat_message("SISTEMA", 
                     f"Tiempo terminado. La palabra era: {self.current_word}")
                 self.word_label.config(text=f"La palabra era: {self.current_word}")
+                
+                if self.history:
+                    self.history.record_scores(self.session_id, self.scores)
+    
+    def current_round_id(self):
+        """Id de la ronda actual en el historial"""
+        return f"{self.session_id}-{self.round_number}"
+    
+    def record_guess(self, name):
+        """Registra en el historial un acierto y su tiempo (host)"""
+        if self.history:
+            self.history.record_guess(self.current_round_id(), name,
+                                      time.time() - self.round_started_at)
     
     def paint(self, event):
         """Maneja el evento de dibujo en el canvas"""
         if not self.am_i_drawing or not self.game_active:
             return
         
+        # Cada trazo recibe un id al comenzar
+        if self.current_stroke is None:
+            self.stroke_counter += 1
+            self.current_stroke = self.stroke_counter
+        
         if self.old_x and self.old_y:
             # Dibujar línea localmente
             self.canvas.create_line(self.old_x, self.old_y, event.x, event.y,
                                    fill=self.color, width=self.brush_size,
-                                   capstyle=tk.ROUND, smooth=True)
+                                   capstyle=tk.ROUND, smooth=True,
+                                   tags=self.stroke_tag(self.current_stroke))
             
             # Enviar coordenadas a otros jugadores
             draw_data = {
@@ -608,7 +1588,9 @@ class Paint3:
                 "x2": event.x,
                 "y2": event.y,
                 "color": self.color,
-                "size": self.brush_size
+                "size": self.brush_size,
+                "stroke": self.current_stroke,
+                "t": self.timestamp_ms()
             }
             
             if self.is_host:
@@ -620,9 +1602,159 @@ class Paint3:
         self.old_y = event.y
     
     def reset(self, event):
-        """Resetea las coordenadas de dibujo"""
+        """Resetea las coordenadas de dibujo y cierra el trazo en curso"""
         self.old_x = None
         self.old_y = None
+        
+        if self.current_stroke is None:
+            return
+        
+        stroke_id = self.current_stroke
+        self.current_stroke = None
+        
+        # Solo se guardan trazos que dibujaron al menos un segmento
+        if not self.canvas.find_withtag(self.stroke_tag(stroke_id)):
+            return
+        
+        self.undo_stack.append(stroke_id)
+        
+        # Un trazo nuevo invalida lo que se podía rehacer
+        if not self.redo_stack:
+            return
+        
+        for stroke_id in self.redo_stack:
+            self.canvas.delete(self.stroke_tag(stroke_id))
+        
+        # Los peers también borran esos trazos ocultos
+        discard_data = {"type": "discard", "strokes": self.redo_stack[:],
+                        "t": self.timestamp_ms()}
+        self.redo_stack.clear()
+        if self.is_host:
+            self.broadcast_data(discard_data)
+        else:
+            self.send_data(discard_data)
+    
+    def timestamp_ms(self):
+        """Marca de tiempo local en ms para ordenar la reproducción"""
+        return round(time.monotonic() * 1000, 1)
+    
+    def valid_canvas_op(self, message):
+        """Revisa los campos de una operación del canvas antes de encolarla"""
+        def number(value):
+            return isinstance(value, (int, float)) and not isinstance(value, bool)
+        
+        def stroke(value):
+            return isinstance(value, int) and not isinstance(value, bool)
+        
+        if "t" in message and not number(message["t"]):
+            return False
+        
+        msg_type = message.get("type")
+        if msg_type == "draw":
+            return (all(number(message.get(k)) for k in ("x1", "y1", "x2", "y2", "size"))
+                    and isinstance(message.get("color"), str)
+                    and stroke(message.get("stroke")))
+        if msg_type in ("undo", "redo"):
+            return stroke(message.get("stroke"))
+        if msg_type == "discard":
+            strokes = message.get("strokes")
+            return isinstance(strokes, list) and all(stroke(s) for s in strokes)
+        return msg_type == "clear"
+    
+    def play_buffered_strokes(self):
+        """Dibuja las operaciones remotas que ya tocan (ciclo con root.after)"""
+        # Se reprograma primero para que un error al dibujar no corte el ciclo
+        if self.running:
+            self.root.after(self.playback_interval, self.play_buffered_strokes)
+        
+        for message in self.jitter_buffer.pop_due(self.timestamp_ms()):
+            try:
+                self.render_canvas_op(message)
+            except (tk.TclError, TypeError, ValueError) as e:
+                print(f"DEBUG: Operación de canvas inválida: {e}")
+        
+        stats = self.jitter_buffer.stats()
+        text = f"Buffer: {stats['delay_ms']:.0f}ms | Underruns: {stats['underruns']}"
+        if self.is_host:
+            limits = self.rate_stats
+            cost = 1e6 * limits["check_time"] / max(1, limits["checks"])
+            text += (f" | Límite: {limits['downsampled']} subm. "
+                     f"{limits['dropped']} desc. {limits['disconnected']} exp. "
+                     f"({cost:.1f}µs/msg)")
+        if self.stats_label.cget("text") != text:
+            self.stats_label.config(text=text)
+    
+    def render_canvas_op(self, message):
+        """Aplica en el canvas una operación recibida de otro jugador"""
+        msg_type = message.get("type")
+        
+        if msg_type == "draw":
+            x1, y1 = message.get("x1"), message.get("y1")
+            x2, y2 = message.get("x2"), message.get("y2")
+            color = message.get("color")
+            size = message.get("size")
+            self.canvas.create_line(x1, y1, x2, y2, 
+                                   fill=color, width=size, 
+                                   capstyle=tk.ROUND, smooth=True,
+                                   tags=self.stroke_tag(message.get("stroke")))
+        
+        elif msg_type == "undo":
+            # Ocultar un trazo completo (sin retransmitir ni redibujar)
+            self.canvas.itemconfigure(self.stroke_tag(message.get("stroke")),
+                                      state=tk.HIDDEN)
+        
+        elif msg_type == "redo":
+            # Volver a mostrar un trazo oculto
+            self.canvas.itemconfigure(self.stroke_tag(message.get("stroke")),
+                                      state=tk.NORMAL)
+        
+        elif msg_type == "discard":
+            # Borrar trazos deshechos que ya no se pueden rehacer
+            for stroke_id in message.get("strokes", []):
+                self.canvas.delete(self.stroke_tag(stroke_id))
+        
+        elif msg_type == "clear":
+            self.canvas.delete("all")
+    
+    def stroke_tag(self, stroke_id):
+        """Devuelve el tag del canvas asociado a un trazo"""
+        return f"stroke{stroke_id}"
+    
+    def reset_stroke_history(self):
+        """Olvida el historial de trazos (nueva ronda o canvas limpio)"""
+        self.current_stroke = None
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+    
+    def undo_stroke(self, event=None):
+        """Oculta el último trazo y avisa a los demás con una operación 'undo'"""
+        if not self.am_i_drawing or not self.game_active or not self.undo_stack:
+            return
+        
+        stroke_id = self.undo_stack.pop()
+        self.redo_stack.append(stroke_id)
+        self.canvas.itemconfigure(self.stroke_tag(stroke_id), state=tk.HIDDEN)
+        
+        undo_data = {"type": "undo", "stroke": stroke_id, "t": self.timestamp_ms()}
+        if self.is_host:
+            self.broadcast_data(undo_data)
+        else:
+            self.send_data(undo_data)
+    
+    def redo_stroke(self, event=None):
+        """Vuelve a mostrar el último trazo deshecho y avisa con 'redo'"""
+        if not self.am_i_drawing or not self.game_active or not self.redo_stack:
+            return
+        
+        stroke_id = self.redo_stack.pop()
+        self.undo_stack.append(stroke_id)
+        self.canvas.itemconfigure(self.stroke_tag(stroke_id), state=tk.NORMAL)
+        
+        redo_data = {"type": "redo", "stroke": stroke_id, "t": self.timestamp_ms()}
+        if self.is_host:
+            self.broadcast_data(redo_data)
+        else:
+            self.send_data(redo_data)
     
     def choose_color(self):
         """Abre selector de color"""
@@ -639,8 +1771,9 @@ class Paint3:
         """Limpia el canvas de dibujo"""
         if self.am_i_drawing and self.game_active:
             self.canvas.delete("all")
+            self.reset_stroke_history()
             
-            clear_data = {"type": "clear"}
+            clear_data = {"type": "clear", "t": self.timestamp_ms()}
             if self.is_host:
                 self.broadcast_data(clear_data)
             else:
@@ -678,6 +1811,8 @@ class Paint3:
                 if self.is_host:
                     self.broadcast_data(correct_data)
                     self.add_chat_message("SISTEMA", f"¡{self.my_name} adivinó la palabra!")
+                    self.record_guess(self.my_name)
+                    self.round_guessers.add(self.my_name)
                 else:
                     self.send_data(correct_data)
                 
@@ -702,6 +1837,8 @@ class Paint3:
     
     def add_chat_message(self, name, text):
         """Agrega un mensaje al chat"""
+        if self.root is None:
+            return
         self.chat_display.config(state=tk.NORMAL)
         timestamp = datetime.now().strftime("%H:%M")
         
@@ -716,6 +1853,8 @@ class Paint3:
     
     def update_players_list(self):
         """Actualiza la lista de jugadores y puntuaciones"""
+        if self.root is None:
+            return
         self.players_listbox.delete(0, tk.END)
         
         # Ordenar por puntuación
@@ -741,6 +1880,15 @@ class Paint3:
             except:
                 pass
         
+        if self.relay_node:
+            self.relay_node.close()
+        
+        if self.history:
+            # Guardar puntajes antes de perderlos (si se jugó) y vaciar la cola
+            if self.round_number > 0:
+                self.history.record_scores(self.session_id, self.scores)
+            self.history.close()
+        
         for peer in self.connected_peers:
             try:
                 peer.close()